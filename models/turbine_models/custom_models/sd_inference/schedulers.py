@@ -4,102 +4,322 @@
 # See https://llvm.org/LICENSE.txt for license information.
 # SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
 
+import copy
+import functools
+import hashlib
 import os
+import shutil
 import sys
 
 import torch
-from torch.fx.experimental.proxy_tensor import make_fx
 from shark_turbine.aot import *
-from iree import runtime as ireert
-import iree.compiler as ireec
 from iree.compiler.ir import Context
-import numpy as np
 
-from turbine_models.custom_models.sd_inference import utils
-from diffusers import (
-    UNet2DConditionModel,
-)
-
-import safetensors
 import argparse
 
 from turbine_models.turbine_tank import turbine_tank
 
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--hf_auth_token", type=str, help="The Hugging Face auth token, required"
-)
-parser.add_argument(
-    "--hf_model_name",
-    type=str,
-    help="HF model name",
-    default="CompVis/stable-diffusion-v1-4",
-)
-parser.add_argument(
-    "--scheduler_id",
-    type=str,
-    help="Scheduler ID",
-    default="PNDM",
-)
-parser.add_argument(
-    "--num_inference_steps", type=int, default=50, help="Number of inference steps"
-)
-parser.add_argument(
-    "--batch_size", type=int, default=1, help="Batch size for inference"
-)
-parser.add_argument(
-    "--height", type=int, default=512, help="Height of Stable Diffusion"
-)
-parser.add_argument("--width", type=int, default=512, help="Width of Stable Diffusion")
-parser.add_argument("--compile_to", type=str, help="torch, linalg, vmfb")
-parser.add_argument("--external_weight_path", type=str, default="")
-parser.add_argument(
-    "--external_weights",
-    type=str,
-    default=None,
-    help="saves ir/vmfb without global weights for size and readability, options [safetensors]",
-)
-parser.add_argument("--device", type=str, default="cpu", help="cpu, cuda, vulkan, rocm")
-# TODO: Bring in detection for target triple
-parser.add_argument(
-    "--iree_target_triple",
-    type=str,
-    default="",
-    help="Specify vulkan target triple or rocm/cuda target device.",
-)
-parser.add_argument("--vulkan_max_allocation", type=str, default="4294967296")
+
+def _build_parser():
+    # Built on demand so importing this module as a library doesn't pay
+    # for argparse setup.
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--hf_auth_token", type=str, help="The Hugging Face auth token, required"
+    )
+    parser.add_argument(
+        "--hf_model_name",
+        type=str,
+        help="HF model name",
+        default="CompVis/stable-diffusion-v1-4",
+    )
+    parser.add_argument(
+        "--scheduler_id",
+        type=str,
+        help="Scheduler ID",
+        default="PNDM",
+    )
+    parser.add_argument(
+        "--num_inference_steps", type=int, default=50, help="Number of inference steps"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=1, help="Batch size for inference"
+    )
+    parser.add_argument(
+        "--height", type=int, default=512, help="Height of Stable Diffusion"
+    )
+    parser.add_argument(
+        "--width", type=int, default=512, help="Width of Stable Diffusion"
+    )
+    parser.add_argument("--compile_to", type=str, help="torch, linalg, vmfb")
+    parser.add_argument("--external_weight_path", type=str, default="")
+    parser.add_argument(
+        "--external_weights",
+        type=str,
+        default=None,
+        help="saves ir/vmfb without global weights for size and readability, options [safetensors]",
+    )
+    parser.add_argument(
+        "--device", type=str, default="cpu", help="cpu, cuda, vulkan, rocm"
+    )
+    # TODO: Bring in detection for target triple
+    parser.add_argument(
+        "--iree_target_triple",
+        type=str,
+        default="",
+        help="Specify vulkan target triple or rocm/cuda target device.",
+    )
+    parser.add_argument("--vulkan_max_allocation", type=str, default="4294967296")
+    parser.add_argument(
+        "--enable_fp16",
+        action="store_true",
+        help="Run the UNet in fp16 + channels_last; scheduler math stays in fp32",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        help="weight-only quantization of the UNet at export, options [bf16]",
+    )
+    parser.add_argument(
+        "--loop_on_host",
+        action="store_true",
+        help="Export only the UNet step; the runner drives the timestep loop and "
+        "scheduler.step eagerly on the host",
+    )
+    return parser
+
+
+@functools.lru_cache(maxsize=2)
+def _load_unet(hf_model_name):
+    # diffusers is imported lazily; it costs seconds at import time and is
+    # not needed when this module is imported as a library.
+    from diffusers import UNet2DConditionModel
+
+    # Loading the UNet materializes multiple GB of weights, so share one
+    # instance per model name across the export and reference paths. The
+    # safetensors path lets the loader mmap the checkpoint instead of
+    # copying it through Python-owned memory, cutting peak RSS at export.
+    return UNet2DConditionModel.from_pretrained(
+        hf_model_name,
+        subfolder="unet",
+        use_safetensors=True,
+        low_cpu_mem_usage=True,
+    )
 
 
 class Scheduler(torch.nn.Module):
-    def __init__(self, hf_model_name, num_inference_steps, scheduler):
+    def __init__(
+        self,
+        hf_model_name,
+        num_inference_steps,
+        scheduler,
+        unet=None,
+        dtype=torch.float32,
+        cfg_mode="batched",
+    ):
         super().__init__()
         self.scheduler = scheduler
         self.scheduler.set_timesteps(num_inference_steps)
-        self.unet = UNet2DConditionModel.from_pretrained(
-            hf_model_name,
-            subfolder="unet",
+        # Pre-unsqueeze the timesteps and pre-read init_noise_sigma so the
+        # denoising loop does no per-step Python-side tensor surgery.
+        self._timesteps = [t.unsqueeze(0).clone() for t in self.scheduler.timesteps]
+        self.init_noise_sigma = float(self.scheduler.init_noise_sigma)
+        # Several schedulers (PNDM, DDIM) implement scale_model_input as an
+        # identity; probe once so the loop can skip the per-step call.
+        probe = torch.zeros(1, 4, 8, 8)
+        self._scale_is_identity = torch.equal(
+            self.scheduler.scale_model_input(probe, self.scheduler.timesteps[0]), probe
         )
+        self.unet = unet if unet is not None else _load_unet(hf_model_name)
+        self.dtype = dtype
+        if self.dtype != torch.float32:
+            # Halved activation bandwidth and tensor-core eligibility for the
+            # UNet conv/matmul kernels, which dominate the denoising loop.
+            # nn.Module.to casts in place, so convert a copy: the incoming
+            # unet may be the shared _load_unet singleton, which must keep
+            # its original precision for other users.
+            self.unet = copy.deepcopy(self.unet).to(
+                dtype=self.dtype, memory_format=torch.channels_last
+            )
         self.guidance_scale = 7.5
+        # "batched" doubles the batch dim to run both CFG halves in one UNet
+        # call (maximizes GPU parallelism); "sequential" runs two half-batch
+        # calls so activation memory can be reused on CPU/NPU-style targets.
+        self.cfg_mode = cfg_mode
 
-    def forward(self, latents, encoder_hidden_states) -> torch.FloatTensor:
-        latents = latents * self.scheduler.init_noise_sigma
-        for t in self.scheduler.timesteps:
+    def _step(self, latents, t, encoder_hidden_states):
+        """One denoising step: latent prep, UNet, CFG combine, scheduler step."""
+        if self.cfg_mode == "sequential":
+            latent_model_input = latents
+            if not self._scale_is_identity:
+                latent_model_input = self.scheduler.scale_model_input(
+                    latent_model_input, timestep=t
+                )
+            if self.dtype != torch.float32:
+                latent_model_input = latent_model_input.to(
+                    dtype=self.dtype, memory_format=torch.channels_last
+                )
+            noise_pred_uncond = self.unet.forward(
+                latent_model_input, t, encoder_hidden_states[0:1], return_dict=False
+            )[0]
+            noise_pred_text = self.unet.forward(
+                latent_model_input, t, encoder_hidden_states[1:2], return_dict=False
+            )[0]
+            if self.dtype != torch.float32:
+                noise_pred_uncond = noise_pred_uncond.float()
+                noise_pred_text = noise_pred_text.float()
+            noise_pred = torch.lerp(
+                noise_pred_uncond, noise_pred_text, self.guidance_scale
+            )
+            return self.scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+        # The two CFG halves see identical latents, so broadcast with a
+        # zero-copy expand rather than materializing the duplicate.
+        if latents.shape[0] == 1:
+            latent_model_input = latents.expand(2, -1, -1, -1)
+        else:
             latent_model_input = torch.cat([latents] * 2)
-            t = t.unsqueeze(0)
+        if not self._scale_is_identity:
             latent_model_input = self.scheduler.scale_model_input(
                 latent_model_input, timestep=t
             )
-            unet_out = self.unet.forward(
-                latent_model_input, t, encoder_hidden_states, return_dict=False
-            )[0]
-            noise_pred_uncond, noise_pred_text = unet_out.chunk(2)
-            noise_pred = noise_pred_uncond + self.guidance_scale * (
-                noise_pred_text - noise_pred_uncond
+        if self.dtype != torch.float32:
+            latent_model_input = latent_model_input.to(
+                dtype=self.dtype, memory_format=torch.channels_last
             )
-            latents = self.scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+        unet_out = self.unet.forward(
+            latent_model_input, t, encoder_hidden_states, return_dict=False
+        )[0]
+        if self.dtype != torch.float32:
+            # Scheduler arithmetic stays in fp32 for accumulation accuracy.
+            unet_out = unet_out.float()
+        noise_pred_uncond, noise_pred_text = unet_out.unflatten(0, (2, -1))
+        # lerp fuses the sub/mul/add of the CFG combine into a single
+        # elementwise kernel, halving the tensor bytes moved per step.
+        noise_pred = torch.lerp(noise_pred_uncond, noise_pred_text, self.guidance_scale)
+        return self.scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+
+    def forward(self, latents, encoder_hidden_states) -> torch.FloatTensor:
+        latents = latents * self.init_noise_sigma
+        if self.dtype != torch.float32:
+            encoder_hidden_states = encoder_hidden_states.to(self.dtype)
+        for t in self._timesteps:
+            latents = self._step(latents, t, encoder_hidden_states)
         return latents
 
 
+class SchedulerUNetStep(torch.nn.Module):
+    """One UNet denoising step without the scheduler update.
+
+    HF scheduler .step() implementations carry Python branches and list
+    state that trace poorly through FX and hinder IREE fusion. Keeping
+    them on the host leaves only the UNet + CFG combine — the actual hot
+    path — in the compiled module.
+    """
+
+    def __init__(self, hf_model_name, unet=None):
+        super().__init__()
+        self.unet = unet if unet is not None else _load_unet(hf_model_name)
+        self.guidance_scale = 7.5
+
+    def forward(self, latents, timestep, encoder_hidden_states) -> torch.FloatTensor:
+        if latents.shape[0] == 1:
+            latent_model_input = latents.expand(2, -1, -1, -1)
+        else:
+            latent_model_input = torch.cat([latents] * 2)
+        unet_out = self.unet.forward(
+            latent_model_input, timestep, encoder_hidden_states, return_dict=False
+        )[0]
+        noise_pred_uncond, noise_pred_text = unet_out.unflatten(0, (2, -1))
+        return torch.lerp(noise_pred_uncond, noise_pred_text, self.guidance_scale)
+
+
+def export_scheduler_step(
+    step_module,
+    hf_model_name,
+    batch_size,
+    height,
+    width,
+    hf_auth_token=None,
+    compile_to="torch",
+    external_weights=None,
+    external_weight_path=None,
+    device=None,
+    target_triple=None,
+    max_alloc=None,
+    upload_ir=False,
+):
+    # Imported lazily; utils pulls in diffusers, iree.compiler, and
+    # safetensors, which cost seconds when this module is imported as a
+    # library.
+    from turbine_models.custom_models.sd_inference import utils
+
+    mapper = {}
+    utils.save_external_weights(
+        mapper, step_module, external_weights, external_weight_path
+    )
+
+    encoder_hidden_states_sizes = (2, 77, 768)
+    if hf_model_name == "stabilityai/stable-diffusion-2-1-base":
+        encoder_hidden_states_sizes = (2, 77, 1024)
+
+    sample = (batch_size, 4, height // 8, width // 8)
+
+    class CompiledSchedulerUnetStep(CompiledModule):
+        if external_weights:
+            params = export_parameters(
+                step_module, external=True, external_scope="", name_mapper=mapper.get
+            )
+        else:
+            params = export_parameters(step_module)
+
+        def main(
+            self,
+            sample=AbstractTensor(*sample, dtype=torch.float32),
+            timestep=AbstractTensor(1, dtype=torch.float32),
+            encoder_hidden_states=AbstractTensor(
+                *encoder_hidden_states_sizes, dtype=torch.float32
+            ),
+        ):
+            return jittable(step_module.forward)(
+                sample, timestep, encoder_hidden_states
+            )
+
+    import_to = "INPUT" if compile_to == "linalg" else "IMPORT"
+    inst = CompiledSchedulerUnetStep(context=Context(), import_to=import_to)
+
+    module_str = str(CompiledModule.get_mlir_module(inst))
+    safe_name = utils.create_safe_name(hf_model_name, "-scheduler-unet-step")
+    if upload_ir:
+        with open(f"{safe_name}.mlir", "w+") as f:
+            f.write(module_str)
+        model_name_upload = hf_model_name.replace("/", "-")
+        model_name_upload = model_name_upload + "_scheduler_unet_step"
+        turbine_tank.uploadToBlobStorage(
+            str(os.path.abspath(f"{safe_name}.mlir")),
+            f"{model_name_upload}/{model_name_upload}.mlir",
+        )
+    if compile_to != "vmfb":
+        return module_str
+    else:
+        if device == "cuda" and not target_triple:
+            target_triple = "sm_80"
+        elif device == "rocm" and not target_triple:
+            target_triple = "gfx90a"
+        utils.compile_to_vmfb(
+            module_str,
+            device,
+            target_triple,
+            max_alloc,
+            safe_name,
+            extra_flags=[
+                "--iree-opt-const-eval=true",
+                "--iree-opt-strip-assertions=true",
+                "--iree-opt-outer-dim-concat=true",
+            ],
+        )
+
+
 def export_scheduler(
     scheduler,
     hf_model_name,
@@ -113,8 +333,25 @@ def export_scheduler(
     device=None,
     target_triple=None,
     max_alloc=None,
+    quantize=None,
     upload_ir=False,
 ):
+    from turbine_models.custom_models.sd_inference import utils
+
+    if quantize == "bf16":
+        # Work on a copy: exporting must not permanently alter the module
+        # it was handed, nor the shared _load_unet cache entry behind it.
+        scheduler = copy.deepcopy(scheduler)
+        scheduler.unet = scheduler.unet.to(torch.bfloat16)
+        # Reuse the reduced-precision cast plumbing in Scheduler.forward.
+        scheduler.dtype = torch.bfloat16
+    elif quantize is not None:
+        # Dynamic int8 quantization packs Linear weights into TorchScript
+        # _packed_params that export_parameters cannot see and the fake-
+        # tensor trace cannot execute, so only bf16 is supported until an
+        # aten-only weight repack exists.
+        raise ValueError(f"Unsupported quantize mode: {quantize}")
+
     mapper = {}
     utils.save_external_weights(
         mapper, scheduler, external_weights, external_weight_path
@@ -160,15 +397,96 @@ def export_scheduler(
     if compile_to != "vmfb":
         return module_str
     else:
-        utils.compile_to_vmfb(module_str, device, target_triple, max_alloc, safe_name)
+        # Default to tensor-core-capable targets when no triple was given;
+        # the generic target misses tensor-core codegen on the UNet
+        # dispatches. Override via --iree_target_triple.
+        if device == "cuda" and not target_triple:
+            target_triple = "sm_80"
+        elif device == "rocm" and not target_triple:
+            target_triple = "gfx90a"
+        # Const-eval folds the embedded UNet params at compile time and
+        # outer-dim-concat handles the per-step doubled-batch concat;
+        # together they shrink the vmfb and its load time.
+        opt_flags = [
+            "--iree-opt-const-eval=true",
+            "--iree-opt-strip-assertions=true",
+            "--iree-opt-outer-dim-concat=true",
+        ]
+        if quantize is not None:
+            # Data tiling activates the packed reduced-precision
+            # microkernel paths for the quantized weights.
+            opt_flags.append("--iree-opt-data-tiling=true")
+        # The MLIR->vmfb stage dominates warm-run wall time, so cache the
+        # compiled artifact. Key on the module text plus everything that
+        # shapes compilation; unlike a hand-picked argument tuple this
+        # cannot go stale when new export options change the module.
+        cache_key = hashlib.sha256(
+            module_str.encode()
+            + repr((device, target_triple, max_alloc, opt_flags)).encode()
+        ).hexdigest()[:16]
+        cache_dir = os.path.expanduser(os.path.join("~", ".cache", "turbine"))
+        cache_path = os.path.join(cache_dir, f"{safe_name}_{cache_key}.vmfb")
+        if os.path.exists(cache_path):
+            shutil.copyfile(cache_path, f"{safe_name}.vmfb")
+            print("Reused cached vmfb from", cache_path)
+            print("Saved to", safe_name + ".vmfb")
+            # The vmfb path terminates the process, mirroring
+            # compile_to_vmfb; callers expecting module text use
+            # compile_to != "vmfb".
+            sys.exit()
+        os.makedirs(cache_dir, exist_ok=True)
+        utils.compile_to_vmfb(
+            module_str,
+            device,
+            target_triple,
+            max_alloc,
+            safe_name,
+            extra_flags=opt_flags,
+            cache_path=cache_path,
+        )
 
 
 if __name__ == "__main__":
-    args = parser.parse_args()
+    args = _build_parser().parse_args()
+    from turbine_models.custom_models.sd_inference import utils
+
     schedulers = utils.get_schedulers(args.hf_model_name)
+    # Validate before _load_unet so a typo doesn't cost a multi-GB load.
+    if args.scheduler_id not in schedulers:
+        sys.exit(
+            f"Unknown scheduler ID '{args.scheduler_id}'; "
+            f"options: {sorted(schedulers)}"
+        )
     scheduler = schedulers[args.scheduler_id]
+    unet = _load_unet(args.hf_model_name)
+    if args.loop_on_host:
+        step_module = SchedulerUNetStep(args.hf_model_name, unet=unet)
+        mod_str = export_scheduler_step(
+            step_module,
+            args.hf_model_name,
+            args.batch_size,
+            args.height,
+            args.width,
+            args.hf_auth_token,
+            args.compile_to,
+            args.external_weights,
+            args.external_weight_path,
+            args.device,
+            args.iree_target_triple,
+            args.vulkan_max_allocation,
+        )
+        safe_name = utils.create_safe_name(args.hf_model_name, "-scheduler-unet-step")
+        with open(f"{safe_name}.mlir", "w+") as f:
+            f.write(mod_str)
+        print("Saved to", safe_name + ".mlir")
+        sys.exit(0)
     scheduler_module = Scheduler(
-        args.hf_model_name, args.num_inference_steps, scheduler
+        args.hf_model_name,
+        args.num_inference_steps,
+        scheduler,
+        unet=unet,
+        dtype=torch.float16 if args.enable_fp16 else torch.float32,
+        cfg_mode="sequential" if args.device == "cpu" else "batched",
     )
     mod_str = export_scheduler(
         scheduler_module,
@@ -183,6 +501,7 @@ if __name__ == "__main__":
         args.device,
         args.iree_target_triple,
         args.vulkan_max_allocation,
+        quantize=args.quantize,
     )
     safe_name = utils.create_safe_name(args.hf_model_name, "-scheduler")
     with open(f"{safe_name}.mlir", "w+") as f:
@@ -2,6 +2,7 @@ import iree.compiler as ireec
 import numpy as np
 import safetensors
 import re
+import shutil
 from diffusers import (
     PNDMScheduler,
 )
@@ -19,7 +20,11 @@ def save_external_weights(
             for name in mod_params:
                 mapper["params." + name] = name
             if external_weight_file:
-                safetensors.torch.save_file(mod_params, external_weight_file)
+                # The "pt" format tag lets the external-params loader mmap
+                # the file at runtime rather than heap-allocating per tensor.
+                safetensors.torch.save_file(
+                    mod_params, external_weight_file, metadata={"format": "pt"}
+                )
                 print("Saved params to", external_weight_file)
 
 
@@ -29,7 +34,15 @@ def largest_error(array1, array2):
     return max_error
 
 
-def compile_to_vmfb(module_str, device, target_triple, max_alloc, safe_name):
+def compile_to_vmfb(
+    module_str,
+    device,
+    target_triple,
+    max_alloc,
+    safe_name,
+    extra_flags=None,
+    cache_path=None,
+):
     flags = [
         "--iree-input-type=torch",
         "--mlir-print-debuginfo",
@@ -74,6 +87,8 @@ def compile_to_vmfb(module_str, device, target_triple, max_alloc, safe_name):
         )
     else:
         print("incorrect device: ", device)
+    if extra_flags:
+        flags.extend(extra_flags)
 
     flatbuffer_blob = ireec.compile_str(
         module_str,
@@ -82,6 +97,9 @@ def compile_to_vmfb(module_str, device, target_triple, max_alloc, safe_name):
     )
     with open(f"{safe_name}.vmfb", "wb+") as f:
         f.write(flatbuffer_blob)
+    if cache_path:
+        shutil.copyfile(f"{safe_name}.vmfb", cache_path)
+        print("Cached vmfb to", cache_path)
     print("Saved to", safe_name + ".vmfb")
     exit()
 